@@ -61,7 +61,7 @@ class GCN(torch.nn.Module):
     def forward(self, node_presentation, edges):
         """
         :param node_presentation:Tensor, size=(num_nodes,input_dim)
-        :param edges: LongTensor, size=(num_edges,2)
+        :param edges: LongTensor, size=(num_edges,2), or sparse adjacency Tensor, see GCNLayer.forward
         :return: new presentations of nodes
         """
         if isinstance(edges, list):
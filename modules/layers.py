@@ -1,13 +1,82 @@
-import numpy as np
 import torch
 import torch.nn as nn
-from scipy.sparse import csr_matrix
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch_geometric.nn import MessagePassing
 from torch_geometric.utils import add_self_loops, degree
 
+from utils.segment import segment_sum, use_segment_sum
+
+
+class GraphMeta(object):
+    def __init__(self, edges, num_node):
+        """
+        Topology of a graph shared by every layer run on it. Build it once per graph and pass it to each layer's
+        forward, so that degrees and sort orders are not recomputed by every layer. Each item is computed on first use.
+        :param edges: LongTensor, size=(num_edge, 3), with the format of (source node, edge, destination node)
+        :param num_node: number of nodes
+        """
+        self.edges = edges
+        self.num_node = num_node
+        self._in_deg = None
+        self._des_perm = None
+        self._rel_perm = None
+        self._rel_count = None
+
+    @property
+    def in_deg(self):
+        # number of edges pointing to each node, size=(num_node,)
+        if self._in_deg is None:
+            self._in_deg = degree(self.edges[:, 2], self.num_node, dtype=torch.long)
+        return self._in_deg
+
+    @property
+    def des_perm(self):
+        # order of edges sorted by destination node
+        if self._des_perm is None:
+            self._des_perm = torch.argsort(self.edges[:, 2])
+        return self._des_perm
+
+    @property
+    def rel_perm(self):
+        # order of edges sorted by relation
+        if self._rel_perm is None:
+            self._rel_perm = torch.argsort(self.edges[:, 1])
+        return self._rel_perm
+
+    @property
+    def rel_count(self):
+        # relations present in the graph in ascending order, and the number of edges of each
+        if self._rel_count is None:
+            rel_unique, count = torch.unique_consecutive(self.edges[self.rel_perm, 1], return_counts=True)
+            self._rel_count = rel_unique, count.tolist()
+        return self._rel_count
+
+
+def get_meta(edges, num_node, meta=None):
+    """
+    :return: meta if given, after a cheap check that it was built on the same graph, otherwise a new GraphMeta
+    """
+    if meta is None:
+        return GraphMeta(edges, num_node)
+    if meta.num_node != num_node or meta.edges.shape != edges.shape:
+        raise ValueError('meta is built on another graph, %d nodes and %d edges are given but it has %d and %d'
+                         % (num_node, edges.shape[0], meta.num_node, meta.edges.shape[0]))
+    return meta
+
+
+def checkpoint_forward(module, *args):
+    """
+    Run module._forward. If module.use_checkpoint is set, activations of the layer are not kept for backward but
+    recomputed from the inputs, trading extra compute for memory.
+    """
+    if module.use_checkpoint and torch.is_grad_enabled():
+        return checkpoint(module._forward, *args, use_reentrant=False)
+    return module._forward(*args)
+
 
 class REGCNLayer(nn.Module):
-    def __init__(self, input_dim, output_dim, bias=False, active='rrelu', dtype=torch.float64):
+    def __init__(self, input_dim, output_dim, bias=False, active='rrelu', dtype=torch.float):
         """
         :param input_dim:
         :param output_dim:
@@ -15,11 +84,11 @@ class REGCNLayer(nn.Module):
         :param active:
         """
         super(REGCNLayer, self).__init__()
-        self.dtype = dtype
         self.input_dim = input_dim
         self.output_dim = output_dim
         self.fc_self = nn.Linear(input_dim, output_dim, bias=bias, dtype=dtype)
         self.fc_aggregate = nn.Linear(input_dim, output_dim, bias=bias, dtype=dtype)
+        self.use_checkpoint = False
         if active == 'rrelu':
             self.active = nn.RReLU()
         elif active == 'sigmoid':
@@ -30,32 +99,29 @@ class REGCNLayer(nn.Module):
     def calculate_message(self, src, rela):
         return self.fc_aggregate(src + rela)
 
-    def aggregate(self, message, num_node, des):
-        des_unique, count = torch.unique(des, return_counts=True)
-        index_matrix = csr_matrix((np.array(range(des_unique.shape[0]), dtype='int64'),
-                                   (des_unique, np.zeros(des_unique.shape[0], dtype='int64'))),
-                                  shape=(num_node, 1))
-        index = torch.zeros(message.shape[0], self.output_dim, dtype=torch.int64) + index_matrix[des].todense()
-        message = torch.zeros(des_unique.shape[0], self.output_dim, dtype=self.dtype).scatter_(0, index, message,
-                                                                                               reduce='add')
-        return des_unique, message / (count.reshape(des_unique.shape[0], 1))
-
-    def forward(self, nodes_embed, edges_embed, edges):
+    def forward(self, nodes_embed, edges_embed, edges, meta=None):
         """
         :param nodes_embed:Tensor, size=(num_node,input_dim)
         :param edges_embed: Tensor,size=(num_edge,input_dim)
         :param edge: Tensor, size=(num_edge, 3), with the format of (source node, edge, destination node)
+        :param meta: GraphMeta of edges, built here if not given
         :return: the representation of node after aggregation
         """
+        # keep the activation outside the checkpoint, RReLU gives wrong gradients when recomputed
+        return self.active(checkpoint_forward(self, nodes_embed, edges_embed, edges, meta))
+
+    def _forward(self, nodes_embed, edges_embed, edges, meta=None):
+        meta = get_meta(edges, nodes_embed.shape[0], meta)
+        src, rela, des = edges.unbind(1)
         # self loop
         h = self.fc_self(nodes_embed)
         # calculate message
-        message = self.calculate_message(nodes_embed[edges[:, 0]], edges_embed[edges[:, 1]])
-        # aggregate
-        des_index, message = self.aggregate(message, nodes_embed.shape[0], edges[:, 2])
-        # send message
-        h[des_index] = h[des_index] + message
-        return self.active(h)
+        message = self.calculate_message(nodes_embed[src], edges_embed[rela])
+        # mean aggregation, scale each message by the in-degree of its destination
+        deg = meta.in_deg.clamp(min=1)
+        message = message / deg[des].unsqueeze(1).to(message.dtype)
+        # aggregate and send message
+        return h.index_add(0, des, message)
 
 
 class WGCNLayer(nn.Module):
@@ -63,9 +129,9 @@ class WGCNLayer(nn.Module):
         super(WGCNLayer, self).__init__()
         self.num_relation = num_relation
         self.input_dim = input_dim
-        self.dtype = dtype
         self.output_dim = output_dim
         self.relation_weight = nn.Parameter(torch.rand((num_relation, 1), dtype=dtype))
+        self.use_checkpoint = False
         self.fc = nn.Linear(input_dim, output_dim, bias=bias, dtype=dtype)
         if active == 'sigmoid':
             self.active = nn.Sigmoid()
@@ -74,43 +140,70 @@ class WGCNLayer(nn.Module):
         else:
             self.active = nn.ReLU()
 
-    def calculate_message(self, src, relation_weight):
-        return self.fc(src * relation_weight)
-
-    def aggregate(self, message, num_node, des):
-        des_unique, count = torch.unique(des, return_counts=True)
-        index_matrix = csr_matrix((np.array(range(des_unique.shape[0]), dtype='int64'),
-                                   (des_unique, np.zeros(des_unique.shape[0], dtype='int64'))),
-                                  shape=(num_node, 1))
-        index = torch.zeros(message.shape[0], message.shape[1], dtype=torch.int64) + index_matrix[des].todense()
-        message = torch.zeros(des_unique.shape[0], self.output_dim, dtype=self.dtype).scatter_(0, index, message,
-                                                                                               reduce='add')
-        return des_unique, message
+    def calculate_message(self, src_proj, relation_weight):
+        """
+        :param src_proj: Tensor, size=(num_edge, output_dim), embeddings of source nodes projected by fc without
+        bias, i.e. src @ W^T
+        :param relation_weight: Tensor, size=(num_edge, 1)
+        :return: Tensor, size=(num_edge, output_dim), relation_weight * src_proj + b, equal to
+        fc(src * relation_weight)
+        """
+        if self.fc.bias is None:
+            return src_proj * relation_weight
+        return torch.addcmul(self.fc.bias, src_proj, relation_weight)
 
-    def forward(self, nodes_embed, edges):
+    def forward(self, nodes_embed, edges, meta=None):
         """
         :param nodes_embed: Tensor, the embedding of nodes, size=(num_node,input_dim)
         :param edges: Tensor, size=(num_edge, 3), with the format of (source node, edge, destination node)
+        :param meta: GraphMeta of edges, built here if not given
         :return: new representation of nodes
         """
-        h = self.fc(nodes_embed)
-        message = self.calculate_message(nodes_embed[edges[:, 0]], self.relation_weight[edges[:, 1]])
-        des_index, message = self.aggregate(message, nodes_embed.shape[0], edges.shape[0], edges[:, 2])
-        h[des_index] = h[des_index] + message
-        return self.active(h)
+        return self.active(checkpoint_forward(self, nodes_embed, edges, meta))
+
+    def _forward(self, nodes_embed, edges, meta=None):
+        meta = get_meta(edges, nodes_embed.shape[0], meta)
+        src, rela, des = edges.unbind(1)
+        # fc is linear, so the projection of nodes is shared by the self loop and the messages
+        proj = F.linear(nodes_embed, self.fc.weight)
+        h = proj if self.fc.bias is None else proj + self.fc.bias
+        message = self.calculate_message(proj[src], self.relation_weight[rela])
+        if use_segment_sum(message):
+            return h + segment_sum(message, des, meta.in_deg, meta.des_perm)
+        # aggregate and send message
+        return h.index_add(0, des, message.to(h.dtype))
 
 
 class GCNLayer(MessagePassing):
-    def __init__(self, in_channels, out_channels):
+    def __init__(self, in_channels, out_channels, cached=False):
+        """
+        :param in_channels:
+        :param out_channels:
+        :param cached: reuse self-loop edges and normalization coefficient while the graph is unchanged
+        """
         super(GCNLayer, self).__init__(aggr='add')
         self.lin = torch.nn.Linear(in_channels, out_channels)
+        self.cached = cached
+        self._cached_src = None
+        self._cached_key = None
+        self._cached_edges = None
+        self._cached_norm = None
+        self.use_checkpoint = False
 
-    def forward(self, node_embed, edges):
-        """
-        :param node_embed: Tensor, size=(num_node, input_dim), Embeddings of nodes
-        :param edge_index: LongTensor ,size=(num_edge, 2), source nodes and destination nodes
-        :return:
-        """
+    def normalize(self, node_embed, edges):
+        if edges.layout != torch.strided:
+            # sparse adjacency, rows are destination nodes, columns are source nodes and values are multiplicities of
+            # edges. The normalization is read off its csr structure, the self loop is returned as a coefficient
+            adj = edges if edges.layout == torch.sparse_csr else edges.to_sparse_csr()
+            crow, col = adj.crow_indices(), adj.col_indices()
+            value = adj.values().to(node_embed.dtype)
+            # degree of source nodes, plus one for the self loop
+            deg = value.new_ones(node_embed.size(0)).index_add_(0, col, value)
+            deg_inv_sqrt = deg.pow(-0.5)
+            deg_inv_sqrt[torch.isinf(deg_inv_sqrt)] = 0
+            row = torch.repeat_interleave(torch.arange(adj.size(0), device=crow.device), crow.diff())
+            norm = deg_inv_sqrt[row] * value * deg_inv_sqrt[col]
+            return torch.sparse_csr_tensor(crow, col, norm, adj.size()), deg_inv_sqrt.pow(2)
         # self loop
         edges, _ = add_self_loops(edges, num_nodes=node_embed.size(0))
         deg = degree(edges[0], node_embed.size(0), dtype=node_embed.dtype)
@@ -118,6 +211,33 @@ class GCNLayer(MessagePassing):
         deg_inv_sqrt[torch.isinf(deg_inv_sqrt)] = 0
         # normalization coefficient
         norm = deg_inv_sqrt[edges[0]] * deg_inv_sqrt[edges[1]]
+        return edges, norm
+
+    def forward(self, node_embed, edges):
+        """
+        :param node_embed: Tensor, size=(num_node, input_dim), Embeddings of nodes
+        :param edges: LongTensor ,size=(2, num_edge), source nodes and destination nodes, or a sparse adjacency
+        Tensor (coo or csr), size=(num_node, num_node), whose rows are destination nodes and columns are source nodes
+        :return:
+        """
+        return checkpoint_forward(self, node_embed, edges)
+
+    def _forward(self, node_embed, edges):
+        # inference tensors have no version counter, graphs created under inference mode are not cached
+        if self.cached and not edges.is_inference():
+            # the cache holds a reference to the input graph, an in-place update of it bumps its version. Results
+            # computed under inference mode can not be saved for backward, so the mode is part of the key
+            key = (edges._version, node_embed.size(0), node_embed.dtype, torch.is_inference_mode_enabled())
+            if edges is not self._cached_src or key != self._cached_key:
+                self._cached_edges, self._cached_norm = self.normalize(node_embed, edges)
+                self._cached_src = edges
+                self._cached_key = key
+            edges, norm = self._cached_edges, self._cached_norm
+        else:
+            edges, norm = self.normalize(node_embed, edges)
+        if edges.layout != torch.strided:
+            # normalized sparse adjacency, aggregate with a single spmm and add the self loop
+            return self.update(torch.sparse.mm(edges, node_embed) + norm.unsqueeze(1) * node_embed)
         # propagate message
         return self.propagate(edges, x=node_embed, norm=norm)
 
@@ -131,66 +251,49 @@ class GCNLayer(MessagePassing):
 
 
 class CompGCNLayer(nn.Module):
-    def __init__(self, input_dim, output_dim, num_rela, dtype=torch.float):
+    def __init__(self, input_dim, output_dim, num_rela, mode='add', dtype=torch.float):
+        """
+        :param input_dim:
+        :param output_dim:
+        :param num_rela:
+        :param mode: Method to composite representations of relations and nodes, 'add', 'sub' or 'mult'
+        :param dtype: dtype of the weights
+        """
         super(CompGCNLayer, self).__init__()
         self.output_dim = output_dim
         self.num_rela = num_rela
-        self.dtype = dtype
-        self.W_o = nn.Linear(input_dim, output_dim, bias=False)
-        self.W_i = nn.Linear(input_dim, output_dim, bias=False)
-        self.W_s = nn.Linear(input_dim, output_dim, bias=False)
-        self.W_r = nn.Linear(input_dim, output_dim, bias=False)
-
-    def composition(self, node_embed, rela_embed, mode='add'):
-        if mode == 'add':
-            res = node_embed + rela_embed
-        elif mode == 'sub':
-            res = node_embed - rela_embed
-        elif mode == 'mult':
-            res = node_embed * rela_embed
-        else:
-            res = None
-        return res
+        compose = {'add': torch.add, 'sub': torch.sub, 'mult': torch.mul}
+        if mode not in compose:
+            raise ValueError("mode must be one of 'add', 'sub' or 'mult', got {!r}".format(mode))
+        self._compose = compose[mode]
+        self.W_o = nn.Linear(input_dim, output_dim, bias=False, dtype=dtype)
+        self.W_i = nn.Linear(input_dim, output_dim, bias=False, dtype=dtype)
+        self.W_s = nn.Linear(input_dim, output_dim, bias=False, dtype=dtype)
+        self.W_r = nn.Linear(input_dim, output_dim, bias=False, dtype=dtype)
+        self.use_checkpoint = False
 
-    def aggregate(self, message, des):
-        des_unique, des_index = torch.unique(des, return_inverse=True)
-        message = torch.zeros(des_unique.shape[0], message.shape[1], dtype=self.dtype).scatter_add_(
-            0, des_index.unsqueeze(1).expand_as(message), message)
-        return des_unique, message
+    def composition(self, node_embed, rela_embed):
+        return self._compose(node_embed, rela_embed)
 
-    def forward(self, node_embed, rela_embed, edges, mode='add'):
+    def forward(self, node_embed, rela_embed, edges):
         """
         :param node_embed:
         :param rela_embed:
         :param edges: LongTensor, including the original edge and reversed edge
-        :param mode: Method to composite representations of relations and nodes
         :return:
         """
+        return checkpoint_forward(self, node_embed, rela_embed, edges)
+
+    def _forward(self, node_embed, rela_embed, edges):
         # self loop
-        h_v = self.W_i(self.composition(node_embed, rela_embed[self.num_rela * 2], mode))
-
-        # original edges
-        index = edges[:, 1] < self.num_rela
-        src = edges[index][:, 0]
-        rela = edges[index][:, 1]
-        des = edges[index][:, 2]
-        index_matrix = torch.zeros(node_embed.shape[0], dtype=torch.long)
-        index_matrix[des] = torch.arange(des.shape[0], dtype=torch.long)
-        message = self.W_o(self.composition(node_embed[src], rela_embed[rela]))
-        message = message[index_matrix[des]]
-        des_index, message = self.aggregate(message, des)
-        h_v[des_index] = h_v[des_index] + message
-
-        # reversed edges
-        index = edges[:, 1] >= self.num_rela
-        src = edges[index][:, 0]
-        rela = edges[index][:, 1]
-        des = edges[index][:, 2]
-        index_matrix[des] = torch.arange(des.shape[0], dtype=torch.long)
-        message = self.W_s(self.composition(node_embed[src], rela_embed[rela]))
-        message = message[index_matrix[des]]
-        des_index, message = self.aggregate(message, des)
-        h_v[des_index] = h_v[des_index] + message
+        h_v = self.W_i(self.composition(node_embed, rela_embed[self.num_rela * 2]))
+
+        src, rela, des = edges.unbind(1)
+        # original edges are projected by W_o, reversed edges by W_s, each edge only once
+        index = rela < self.num_rela
+        for mask, W in ((index, self.W_o), (~index, self.W_s)):
+            message = W(self.composition(node_embed[src[mask]], rela_embed[rela[mask]]))
+            h_v = h_v.index_add(0, des[mask], message)
 
         # update relation representation
         h_r = self.W_r(rela_embed)
@@ -198,45 +301,90 @@ class CompGCNLayer(nn.Module):
 
 
 class RGCNLayer(nn.Module):
-    def __init__(self, input_dim, output_dim, num_rels):
+    def __init__(self, input_dim, output_dim, num_rels, num_bases=None):
+        """
+        :param input_dim:
+        :param output_dim:
+        :param num_rels:
+        :param num_bases: number of basis matrices shared by all relations, None for one full matrix per relation
+        """
         super(RGCNLayer, self).__init__()
         self.input_dim = input_dim
         self.output_dim = output_dim
         self.num_rels = num_rels
-        self.weight = nn.Parameter(torch.Tensor(num_rels, input_dim, output_dim))
+        if num_bases is not None and num_bases < num_rels:
+            # basis decomposition, W_r = sum_b coeff[r, b] * bases[b]
+            self.num_bases = num_bases
+            self.bases = nn.Parameter(torch.Tensor(num_bases, input_dim, output_dim))
+            self.coeff = nn.Parameter(torch.Tensor(num_rels, num_bases))
+            nn.init.xavier_uniform_(self.bases, gain=nn.init.calculate_gain('relu'))
+            nn.init.xavier_uniform_(self.coeff)
+        else:
+            self.num_bases = None
+            self.weight = nn.Parameter(torch.Tensor(num_rels, input_dim, output_dim))
+            nn.init.xavier_uniform_(self.weight, gain=nn.init.calculate_gain('relu'))
         self.self_loop_weigt = nn.Parameter(torch.Tensor(input_dim, output_dim))
-        nn.init.xavier_uniform_(self.weight, gain=nn.init.calculate_gain('relu'))
+        self.use_checkpoint = False
 
-    def aggregate(self, message, des):
-        des_unique, des_index, count = torch.unique(des, return_inverse=True, return_counts=True)
-        message = torch.zeros(des_unique.shape[0], message.shape[1], dtype=message.dtype).scatter_add_(
-            0, des_index.unsqueeze(1).expand_as(message), message)
-        return des_unique, message / count.reshape(-1, 1)
+    def calculate_message(self, src_h, rel_unique, count):
+        """
+        :param src_h: Tensor, size=(num_edge, input_dim), embeddings of source nodes, sorted by relation
+        :param rel_unique: LongTensor, relations present in the graph in ascending order
+        :param count: list, number of edges of each relation in rel_unique
+        :return: Tensor, size=(num_edge, output_dim)
+        """
+        if len(count) == 0:
+            # graph without edges
+            return src_h.new_zeros(0, self.output_dim)
+        if self.num_bases is None:
+            weight = self.weight[rel_unique]
+        else:
+            # only materialize the matrices of relations present in the graph
+            weight = torch.einsum('rb,bio->rio', self.coeff[rel_unique], self.bases)
+        return torch.cat([src_h_r @ weight_r for weight_r, src_h_r in
+                          zip(weight, torch.split(src_h, count))])
 
-    def forward(self, h, edges):
+    def forward(self, h, edges, meta=None):
         """
         :param h: node embeddings, shape (num_nodes, input_dim)
         :param edges: list of triplets (src, rel, dst)
+        :param meta: GraphMeta of edges, built here if not given
         :return: new node embeddings, shape (num_nodes, output_dim)
         """
+        return checkpoint_forward(self, h, edges, meta)
+
+    def _forward(self, h, edges, meta=None):
+        meta = get_meta(edges, h.shape[0], meta)
         # separate triplets into src, rel, dst
-        src, rel, dst = edges.transpose(0, 1)
-        # gather node embeddings by indices
-        src_h = h[src]
-        # gather relation weights by indices
-        weight = self.weight[rel]
-        index_matrix = torch.zeros(h.shape[0], dtype=torch.long)
-        index_matrix[dst] = torch.arange(dst.shape[0], dtype=torch.long)
-        msg = torch.bmm(src_h.unsqueeze(1), weight).squeeze(1)
-        # sort message corresponding to destination node
-        msg = msg[index_matrix[dst]]
-        # aggregate message
-        dst_index, msg = self.aggregate(msg, dst)
+        src, rel, dst = edges.unbind(1)
+        # group edges by relation so that each relation is a single dense matmul, the group sizes depend on the
+        # data, so torch.compile breaks the graph here
+        src, dst = src[meta.rel_perm], dst[meta.rel_perm]
+        msg = self.calculate_message(h[src], *meta.rel_count)
+        # mean aggregation, scale each message by the in-degree of its destination
+        deg = meta.in_deg.clamp(min=1)
+        msg = msg / deg[dst].unsqueeze(1).to(msg.dtype)
         # self loop message passing
         out = torch.mm(h, self.self_loop_weigt)
-        # compose message
-        out[dst_index] = out[dst_index] + msg
-        return out
-
+        # aggregate and send message
+        return out.index_add(0, dst, msg)
 
 
+def compile_layer(module, mode=None, dynamic=True):
+    """
+    Compile a layer or a stack of layers with torch.compile, so that composition, linear projection and
+    aggregation are fused into fewer kernels. Checked with torch._dynamo.explain: REGCNLayer, WGCNLayer (with
+    autograd on) and GCNLayer without cache trace to a single graph. Data dependent steps break the graph and run
+    eagerly: the cache lookup of GCNLayer with cached=True on an edge index, the direction masks of CompGCNLayer and
+    the relation grouping of RGCNLayer. The kernels between the breaks are still compiled.
+    :param module: nn.Module
+    :param mode: torch.compile mode, 'default' or 'max-autotune-no-cudagraphs' with dynamic shapes if not given.
+    CUDA graphs are avoided since they are recorded for every new number of edges
+    :param dynamic: the number of edges changes between graphs, so dynamic shapes are enabled by default
+    :return: compiled module, or the module itself if torch.compile is not available
+    """
+    if not hasattr(torch, 'compile'):
+        return module
+    if mode is None:
+        mode = 'max-autotune-no-cudagraphs' if dynamic else 'default'
+    return torch.compile(module, mode=mode, dynamic=dynamic)
@@ -10,3 +10,14 @@ des = torch.randint(0, 30, (1, 20))
 rela = torch.randint(0, 10, (1, 20))
 edge = torch.cat([src, rela, des], dim=0).T
 res = model.forward(node_ebd, edge_ebd, edge[:, [0, 1]])
+
+# the numba segment sum must agree with index_add_, including empty segments, no edges and float64
+from utils.segment import segment_sum
+
+for dtype in (torch.float32, torch.float64):
+    for num_edge in (0, 1, 20):
+        message = torch.randn((num_edge, 16), dtype=dtype)
+        index = torch.randint(0, 30, (num_edge,))
+        count = torch.bincount(index, minlength=30)
+        expect = torch.zeros((30, 16), dtype=dtype).index_add_(0, index, message)
+        assert torch.allclose(segment_sum(message, index, count), expect)
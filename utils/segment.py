@@ -0,0 +1,44 @@
+import numpy as np
+import torch
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _segment_sum(message, perm, seg_ptr, out):
+        for i in prange(seg_ptr.shape[0] - 1):
+            for k in range(seg_ptr[i], seg_ptr[i + 1]):
+                e = perm[k]
+                for j in range(message.shape[1]):
+                    out[i, j] += message[e, j]
+
+
+def use_segment_sum(message: torch.Tensor):
+    """
+    The numba kernel runs outside autograd, so it is only used for float32/float64 cpu tensors that need no
+    gradient.
+    """
+    return njit is not None and message.device.type == 'cpu' and message.dtype in (torch.float, torch.double) and not (
+            torch.is_grad_enabled() and message.requires_grad)
+
+
+def segment_sum(message: torch.Tensor, index: torch.Tensor, count: torch.Tensor, perm: torch.Tensor = None):
+    """
+    :param message: Tensor, size=(num_edge, dim)
+    :param index: LongTensor, size=(num_edge,), segment of each message
+    :param count: LongTensor, size=(num_segment,), number of messages in each segment, may contain zeros
+    :param perm: LongTensor, size=(num_edge,), order of messages sorted by index, computed if not given
+    :return: Tensor, size=(num_segment, dim), sum of the messages in each segment
+    """
+    if perm is None:
+        perm = torch.argsort(index)
+    seg_ptr = np.zeros(count.shape[0] + 1, dtype=np.int64)
+    np.cumsum(count.numpy(), out=seg_ptr[1:])
+    # messages are read in place through perm, gathering them in sorted order would cost more than the sum itself
+    message = message.numpy()
+    out = np.zeros((count.shape[0], message.shape[1]), dtype=message.dtype)
+    _segment_sum(message, perm.numpy(), seg_ptr, out)
+    return torch.from_numpy(out)